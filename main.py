@@ -1,9 +1,20 @@
 import os
+import re
+import sys
 import json
 import time
 import csv
+import gzip
+import subprocess
+import cProfile
+import tracemalloc
 import requests
+import math
+import heapq
 import smtplib
+import sqlite3
+import hashlib
+import statistics
 from datetime import datetime, timezone, timedelta
 from urllib.parse import urlparse, unquote
 from email.mime.text import MIMEText
@@ -29,11 +40,24 @@ except Exception:
     HAS_MYSQL_CONNECTOR = False
 
 try:
-    from pymongo import MongoClient  # pip install pymongo
+    from pymongo import MongoClient, ReplaceOne  # pip install pymongo
     HAS_MONGO = True
 except Exception:
     HAS_MONGO = False
 
+try:
+    import resource  # Unix only (peak RSS)
+    HAS_RESOURCE = True
+except Exception:
+    HAS_RESOURCE = False
+
+try:
+    import pyarrow as pa  # pip install pyarrow
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except Exception:
+    HAS_PYARROW = False
+
 try:
     from tabulate import tabulate  # pip install tabulate
     HAS_TABULATE = True
@@ -65,6 +89,1035 @@ EMAIL_TO_DEFAULT = [
 
 DB_TARGETS_FILE = os.getenv("PIPELINE_DB_TARGETS_FILE", "db_targets.json")
 
+# Email: outbox local + worker em background (fora do caminho crítico)
+EMAIL_OUTBOX_DIR = os.getenv("PIPELINE_EMAIL_OUTBOX_DIR", "outbox")
+EMAIL_ASYNC = (os.getenv("PIPELINE_EMAIL_ASYNC") or "1").strip().lower() not in ("0", "false", "no")
+EMAIL_POLICY = (os.getenv("PIPELINE_EMAIL_POLICY") or "always").strip().lower()  # always | failure | never
+EMAIL_DIGEST_N = int(os.getenv("PIPELINE_EMAIL_DIGEST_N") or "0")
+EMAIL_DIGEST_WINDOW_MIN = float(os.getenv("PIPELINE_EMAIL_DIGEST_WINDOW_MIN") or "0")
+OUTBOX_LOCK_RETRIES = 5  # segundos à espera do lock antes de deixar o envio ao worker que o tem
+
+if EMAIL_POLICY not in ("always", "failure", "never"):
+    raise ValueError("PIPELINE_EMAIL_POLICY inválido: always | failure | never")
+
+# Profiling opt-in (PIPELINE_PROFILE=1 ou --profile): cProfile + tracemalloc por etapa
+PROFILE = (os.getenv("PIPELINE_PROFILE") or "0").strip().lower() in ("1", "true", "yes") or "--profile" in sys.argv[1:]
+PROFILE_DIR = os.getenv("PIPELINE_PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.getenv("PIPELINE_PROFILE_TOP_N") or "15")
+PROFILE_ALLOC_INTERVALS = int(os.getenv("PIPELINE_PROFILE_ALLOC_INTERVALS") or "1")  # pares de snapshots por etapa (dedup/insert repetem por batch)
+
+# Histórico de execuções + deteção de regressões (vazio = desligado)
+HISTORY_DB = (os.getenv("PIPELINE_HISTORY_DB") if os.getenv("PIPELINE_HISTORY_DB") is not None else "run_history.sqlite").strip()
+HISTORY_WINDOW = int(os.getenv("PIPELINE_HISTORY_WINDOW") or "20")
+HISTORY_MIN_RUNS = int(os.getenv("PIPELINE_HISTORY_MIN_RUNS") or "5")
+REGRESSION_FACTOR = float(os.getenv("PIPELINE_REGRESSION_FACTOR") or "2.0")
+REGRESSION_MIN_SECS = float(os.getenv("PIPELINE_REGRESSION_MIN_SECS") or "0.5")
+REGRESSION_EXIT_CODE = int(os.getenv("PIPELINE_REGRESSION_EXIT_CODE") or "3")
+
+# Última observação por (fonte, lugar): snapshot SQLite + API HTTP local (vazio = desligado)
+LATEST_DB = (os.getenv("PIPELINE_LATEST_DB") if os.getenv("PIPELINE_LATEST_DB") is not None else "latest.sqlite").strip()
+LATEST_HTTP_HOST = os.getenv("PIPELINE_LATEST_HTTP_HOST", "127.0.0.1")
+LATEST_HTTP_PORT = int(os.getenv("PIPELINE_LATEST_HTTP_PORT") or "8088")
+
+# Estações: metadados IPMA / aeródromos ICAO (cache em disco) + resolver de estações mais próximas
+IPMA_STATIONS_URL = os.getenv("IPMA_STATIONS_URL", "https://api.ipma.pt/open-data/observation/meteorology/stations/stations.json")
+
+# filtro de estações (vazio = todas) e nomes "id:nome" separados por , ou ;
+IPMA_STATION_IDS = {s.strip() for s in (os.getenv("IPMA_STATION_IDS") or "").split(",") if s.strip()}
+IPMA_STATION_NAMES = {}
+for _part in re.split(r"[,;]\s*(?=\d+\s*:)", os.getenv("IPMA_STATION_NAMES") or ""):
+    if ":" in _part:
+        _sid, _nm = _part.split(":", 1)
+        if _sid.strip() and _nm.strip():
+            IPMA_STATION_NAMES[_sid.strip()] = _nm.strip()
+
+IPMA_FETCH_STATIONS_META = (os.getenv("IPMA_FETCH_STATIONS_META") or "0").strip().lower() in ("1", "true", "yes")
+IPMA_STATIONS_CACHE = os.getenv("IPMA_STATIONS_CACHE", "ipma_stations_cache.json")
+IPMA_STATIONS_TTL_H = float(os.getenv("IPMA_STATIONS_TTL_H") or "168")
+
+ICAO_STATIONS_URL = os.getenv("ICAO_STATIONS_URL", "https://aviationweather.gov/api/data/stationinfo")
+ICAO_STATIONS_BBOX = os.getenv("ICAO_STATIONS_BBOX", "29,-32,44,-6")  # lat0,lon0,lat1,lon1 (PT + ilhas)
+ICAO_STATIONS_CACHE = os.getenv("ICAO_STATIONS_CACHE", "icao_stations_cache.json")
+ICAO_STATIONS_TTL_H = float(os.getenv("ICAO_STATIONS_TTL_H") or "168")
+
+NEAREST_LAT = float(os.getenv("PIPELINE_NEAREST_LAT")) if (os.getenv("PIPELINE_NEAREST_LAT") or "").strip() else None
+NEAREST_LON = float(os.getenv("PIPELINE_NEAREST_LON")) if (os.getenv("PIPELINE_NEAREST_LON") or "").strip() else None
+NEAREST_K = int(os.getenv("PIPELINE_NEAREST_K") or "3")
+NEAREST_ANNOTATE = (os.getenv("PIPELINE_NEAREST_ANNOTATE") or "0").strip().lower() in ("1", "true", "yes")
+
+
+# =========================
+# Notifications (outbox)
+# =========================
+def outbox_enqueue(subject, body_html, email_to, failed=False, regression=False):
+    """Grava o email no outbox (escrita atómica) e devolve o caminho."""
+    os.makedirs(EMAIL_OUTBOX_DIR, exist_ok=True)
+    now = time.time()
+    msg = {
+        "created": now,
+        "created_utc": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "subject": subject,
+        "html": body_html,
+        "to": list(email_to),
+        "failed": bool(failed),
+        "regression": bool(regression),
+    }
+    fname = f"{int(now * 1000):015d}_{os.getpid()}.json"
+    path = os.path.join(EMAIL_OUTBOX_DIR, fname)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(msg, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+
+def outbox_spawn_worker():
+    """Lança `main.py --flush-outbox` destacado; devolve False se não for possível."""
+    script = globals().get("__file__")
+    if not script:
+        return False
+
+    os.makedirs(EMAIL_OUTBOX_DIR, exist_ok=True)
+    log = open(os.path.join(EMAIL_OUTBOX_DIR, "worker.log"), "a", encoding="utf-8")
+    kwargs = {"stdin": subprocess.DEVNULL, "stdout": log, "stderr": log, "close_fds": True}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(script), "--flush-outbox"], **kwargs)
+        return True
+    except Exception as e:
+        print(f"Falha ao lançar worker de email: {e}")
+        return False
+    finally:
+        log.close()
+
+
+def _outbox_lock():
+    lock = os.path.join(EMAIL_OUTBOX_DIR, ".lock")
+    for _ in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            return lock
+        except FileExistsError:
+            # lock de um worker que morreu -> libertar
+            try:
+                if time.time() - os.path.getmtime(lock) > 600:
+                    os.remove(lock)
+                    continue
+            except Exception:
+                pass
+            return None
+    return None
+
+
+def _send_email(subject, body_html, email_to, session):
+    """Resend -> SMTP fallback. `session` guarda a sessão HTTP e a ligação SMTP entre envios."""
+    resend_key = (os.getenv("RESEND_API_KEY") or "").strip()
+    resend_from = (os.getenv("RESEND_FROM") or "").strip() or EMAIL_FROM_DEFAULT
+
+    if resend_key:
+        try:
+            if session.get("http") is None:
+                session["http"] = requests.Session()
+            payload = {"from": resend_from, "to": email_to, "subject": subject, "html": body_html}
+            r = session["http"].post(
+                "https://api.resend.com/emails",
+                headers={"Authorization": f"Bearer {resend_key}", "Content-Type": "application/json"},
+                json=payload,
+                timeout=20,
+            )
+            r.raise_for_status()
+            print("Email enviado com sucesso (Resend).")
+            return True
+        except Exception as e:
+            print(f"Falha ao enviar email via Resend: {e}")
+
+    try:
+        smtp_host = os.getenv("SMTP_HOST", "smtp.gmail.com")
+        smtp_port = int(os.getenv("SMTP_PORT", "587"))
+        smtp_user = os.getenv("SMTP_USER")
+        smtp_pass = os.getenv("SMTP_PASS")
+        if not smtp_user or not smtp_pass:
+            raise RuntimeError("Faltam SMTP_USER / SMTP_PASS.")
+
+        msg = MIMEMultipart("alternative")
+        msg["Subject"] = subject
+        msg["To"] = ", ".join(email_to)
+        msg["From"] = os.getenv("PIPELINE_EMAIL_FROM") or smtp_user or EMAIL_FROM_DEFAULT
+        msg.attach(MIMEText(body_html, "html"))
+
+        # uma única sessão STARTTLS+login para todo o flush
+        if session.get("smtp") is None:
+            server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+            server.login(smtp_user, smtp_pass)
+            session["smtp"] = server
+        session["smtp"].send_message(msg)
+
+        print("Email enviado com sucesso (SMTP).")
+        return True
+    except Exception as e:
+        print(f"Falha ao enviar email (SMTP): {e}")
+        try:
+            if session.get("smtp") is not None:
+                session["smtp"].close()
+        except Exception:
+            pass
+        session["smtp"] = None
+        return False
+
+
+def _html_body(html):
+    lo = html.lower()
+    i = lo.find("<body>")
+    j = lo.rfind("</body>")
+    if i >= 0 and j > i:
+        return html[i + len("<body>"):j]
+    return html
+
+
+def _outbox_names():
+    return sorted(f for f in os.listdir(EMAIL_OUTBOX_DIR) if f.endswith(".json"))
+
+
+def _outbox_send_pending(names, session):
+    """Uma passagem pelo outbox. Devolve (emails enviados, False se um envio falhou)."""
+    sent = 0
+    msgs = []
+    for fname in names:
+        path = os.path.join(EMAIL_OUTBOX_DIR, fname)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                m = json.load(f)
+            m["_path"] = path
+            msgs.append(m)
+        except Exception as e:
+            print(f"Mensagem inválida no outbox ({fname}): {e}")
+
+    if not msgs:
+        return 0, True
+
+    digest = EMAIL_DIGEST_N > 0 or EMAIL_DIGEST_WINDOW_MIN > 0
+    if digest:
+        # falhas e regressões saem logo; caso contrário espera por N execuções ou pela janela de tempo
+        due = any(m.get("failed") or m.get("regression") for m in msgs)
+        if EMAIL_DIGEST_N > 0 and len(msgs) >= EMAIL_DIGEST_N:
+            due = True
+        if EMAIL_DIGEST_WINDOW_MIN > 0 and time.time() - float(msgs[0].get("created") or 0) >= EMAIL_DIGEST_WINDOW_MIN * 60:
+            due = True
+        if not due:
+            print(f"Digest: {len(msgs)} execução(ões) pendente(s), ainda não enviado.")
+            return 0, True
+        groups = [msgs]
+    else:
+        groups = [[m] for m in msgs]
+
+    for group in groups:
+        if len(group) == 1:
+            subject = group[0]["subject"]
+            body_html = group[0]["html"]
+        else:
+            n_failed = sum(1 for m in group if m.get("failed"))
+            subject = f"Pipeline {PIPELINE_NAME} - Digest de {len(group)} execuções ({PIPELINE_ENV})"
+            if n_failed:
+                subject += f" - {n_failed} com falha"
+            parts = [f"<p><b>Digest: {len(group)} execuções ({n_failed} com falha)</b></p>"]
+            for m in group:
+                flag = " (FALHA)" if m.get("failed") else (" (REGRESSÃO)" if m.get("regression") else "")
+                parts.append(f"<hr><p><b>{m.get('created_utc', '')} UTC{flag}</b></p>")
+                parts.append(_html_body(m["html"]))
+            body_html = "<html><body>" + "\n".join(parts) + "</body></html>"
+
+        email_to = group[-1].get("to") or EMAIL_TO_DEFAULT
+        if not _send_email(subject, body_html, email_to, session):
+            return sent, False  # fica no outbox para a próxima tentativa
+
+        for m in group:
+            try:
+                os.remove(m["_path"])
+            except Exception:
+                pass
+        sent += 1
+    return sent, True
+
+
+def outbox_flush():
+    """Envia o outbox. Em modo digest junta as execuções pendentes num só email. Devolve nº de emails enviados."""
+    if not os.path.isdir(EMAIL_OUTBOX_DIR):
+        return 0
+
+    lock = None
+    for _ in range(OUTBOX_LOCK_RETRIES + 1):
+        lock = _outbox_lock()
+        if lock is not None:
+            break
+        time.sleep(1)
+    if lock is None:
+        # o worker que tem o lock volta a listar o outbox antes de o libertar
+        print("Outbox ocupado por outro worker.")
+        return 0
+
+    session = {"http": None, "smtp": None}
+    sent = 0
+    try:
+        # repetir enquanto chegarem mensagens novas durante o envio
+        seen = set()
+        while True:
+            names = _outbox_names()
+            if not names or seen.issuperset(names):
+                break
+            seen.update(names)
+            n, ok = _outbox_send_pending(names, session)
+            sent += n
+            if not ok:
+                break
+    finally:
+        if session.get("smtp") is not None:
+            try:
+                session["smtp"].quit()
+            except Exception:
+                pass
+        try:
+            os.remove(lock)
+        except Exception:
+            pass
+
+    return sent
+
+
+# =========================
+# Latest-observation snapshot
+# =========================
+def _latest_connect(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS latest ("
+        " fonte TEXT NOT NULL, lugar TEXT NOT NULL, data TEXT NOT NULL, payload TEXT NOT NULL,"
+        " PRIMARY KEY (fonte, lugar))"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL)")
+    return conn
+
+
+def latest_update(rows_in, path=None):
+    """Atualiza o snapshot com as linhas da execução (só se forem mais recentes). Devolve nº de estações alteradas."""
+    path = path or LATEST_DB
+    newest = {}
+    for r in rows_in:
+        key = (str(r.get("fonte") or "UNKNOWN"), str(r.get("lugar")))
+        if key not in newest or r["data"] > newest[key]["data"]:
+            newest[key] = r
+
+    conn = _latest_connect(path)
+    try:
+        before = conn.total_changes
+        with conn:
+            for (fonte, lugar), r in newest.items():
+                d = {c: r.get(c) for c in r if c != "data"}
+                d["data"] = r["data"].strftime("%Y-%m-%dT%H:%M:%SZ")
+                conn.execute(
+                    "INSERT INTO latest (fonte, lugar, data, payload) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (fonte, lugar) DO UPDATE SET data=excluded.data, payload=excluded.payload "
+                    "WHERE excluded.data > latest.data",
+                    (fonte, lugar, d["data"], json.dumps(d, ensure_ascii=False, default=str)),
+                )
+            changed = conn.total_changes - before
+            if changed:
+                conn.execute("INSERT INTO meta (k, v) VALUES ('version', 1) ON CONFLICT (k) DO UPDATE SET v = v + 1")
+        return changed
+    finally:
+        conn.close()
+
+
+def serve_latest(host, port, path=None):
+    """API JSON local: /latest, /latest/<fonte>, /latest/<fonte>/<lugar> (com ETag / If-None-Match)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    path = path or LATEST_DB
+    conn = _latest_connect(path)
+    conn.close()
+
+    state = {"version": None, "checked": 0.0, "by_key": {}, "by_fonte": {}}
+
+    def refresh():
+        # no máximo uma leitura à BD por segundo; o resto é servido do índice em memória
+        now = time.monotonic()
+        if now - state["checked"] < 1.0:
+            return
+        state["checked"] = now
+        c = sqlite3.connect(path, timeout=10)
+        try:
+            row = c.execute("SELECT v FROM meta WHERE k='version'").fetchone()
+            version = row[0] if row else 0
+            if version == state["version"]:
+                return
+            by_key = {}
+            by_fonte = {}
+            for fonte, lugar, data, payload in c.execute("SELECT fonte, lugar, data, payload FROM latest"):
+                body = payload.encode("utf-8")
+                etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+                by_key[(fonte, lugar)] = (body, etag)
+                by_fonte.setdefault(fonte, []).append(payload)
+            state["by_key"] = by_key
+            state["by_fonte"] = {f: ("[" + ",".join(v) + "]").encode("utf-8") for f, v in by_fonte.items()}
+            state["all"] = ("[" + ",".join(p for v in by_fonte.values() for p in v) + "]").encode("utf-8")
+            state["version"] = version
+        finally:
+            c.close()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body=b"", etag=None):
+            if etag and self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+            self.send_response(status)
+            if etag:
+                self.send_header("ETag", etag)
+            if status != 304:
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            try:
+                refresh()
+            except Exception as e:
+                return self._send(503, json.dumps({"error": str(e)}).encode("utf-8"))
+
+            parts = [unquote(p) for p in urlparse(self.path).path.split("/") if p]
+            if not parts or parts[0] != "latest" or len(parts) > 3:
+                return self._send(404, b'{"error": "not found"}')
+
+            version_etag = f'"v{state["version"]}"'
+            if len(parts) == 1:
+                return self._send(200, state.get("all") or b"[]", version_etag)
+            if len(parts) == 2:
+                return self._send(200, state["by_fonte"].get(parts[1], b"[]"), version_etag)
+
+            hit = state["by_key"].get((parts[1], parts[2]))
+            if hit is None:
+                return self._send(404, b'{"error": "not found"}')
+            return self._send(200, hit[0], hit[1])
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"A servir últimas observações ({path}) em http://{host}:{port}/latest")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# =========================
+# Station metadata (cache em disco com TTL)
+# =========================
+def _load_cached_stations(cache_path, ttl_h, fetch, label):
+    """Devolve {station_id: {"name", "lat", "lon"}} da cache; chama `fetch()` quando expira (usa cache antiga se falhar)."""
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except Exception:
+            cached = None
+
+    if cached and time.time() - float(cached.get("fetched") or 0) < ttl_h * 3600:
+        return cached.get("stations") or {}
+
+    try:
+        stations = fetch()
+        if cache_path:
+            tmp = cache_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"fetched": time.time(), "stations": stations}, f, ensure_ascii=False)
+            os.replace(tmp, cache_path)
+        return stations
+
+    except Exception as e:
+        if cached:
+            print(f"Falha a atualizar metadados {label} ({e}); a usar cache antiga.")
+            return cached.get("stations") or {}
+        raise
+
+
+def _fetch_ipma_stations():
+    resp = requests.get(IPMA_STATIONS_URL, timeout=20)
+    resp.raise_for_status()
+    payload = resp.json()
+    if not isinstance(payload, list):
+        raise ValueError("Resposta IPMA stations inesperada (esperado lista GeoJSON).")
+
+    stations = {}
+    for feat in payload:
+        if not isinstance(feat, dict):
+            continue
+        props = feat.get("properties") or {}
+        coords = (feat.get("geometry") or {}).get("coordinates") or [None, None]
+        sid = props.get("idEstacao")
+        if sid is None or len(coords) < 2:
+            continue
+        stations[str(sid)] = {"name": props.get("localEstacao"), "lat": coords[1], "lon": coords[0]}
+    return stations
+
+
+def _fetch_icao_stations():
+    resp = requests.get(ICAO_STATIONS_URL, params={"bbox": ICAO_STATIONS_BBOX, "format": "json"}, timeout=30)
+    resp.raise_for_status()
+    payload = resp.json()
+    if not isinstance(payload, list):
+        raise ValueError("Resposta ICAO stationinfo inesperada (esperado list[dict]).")
+
+    stations = {}
+    for item in payload:
+        if not isinstance(item, dict):
+            continue
+        icao = (item.get("icaoId") or item.get("id") or "").strip().upper()
+        if not icao or item.get("lat") is None or item.get("lon") is None:
+            continue
+        stations[icao] = {"name": item.get("site"), "lat": float(item["lat"]), "lon": float(item["lon"])}
+    return stations
+
+
+def load_ipma_stations_meta():
+    return _load_cached_stations(IPMA_STATIONS_CACHE, IPMA_STATIONS_TTL_H, _fetch_ipma_stations, "IPMA")
+
+
+def load_icao_stations_meta():
+    return _load_cached_stations(ICAO_STATIONS_CACHE, ICAO_STATIONS_TTL_H, _fetch_icao_stations, "ICAO")
+
+
+# =========================
+# Nearest-station resolver (KD-tree em coordenadas 3D da esfera unitária)
+# =========================
+EARTH_RADIUS_KM = 6371.0088
+_STATION_INDEX = {}
+
+
+def _xyz(lat, lon):
+    la = math.radians(float(lat))
+    lo = math.radians(float(lon))
+    return (math.cos(la) * math.cos(lo), math.cos(la) * math.sin(lo), math.sin(la))
+
+
+def build_station_index(stations):
+    """KD-tree sobre {id: {"lat", "lon", ...}}; nós = (xyz, id, eixo, esquerda, direita)."""
+    pts = [(_xyz(m["lat"], m["lon"]), sid) for sid, m in stations.items()
+           if m.get("lat") is not None and m.get("lon") is not None]
+
+    def build(items, depth):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda it: it[0][axis])
+        mid = len(items) // 2
+        return (items[mid][0], items[mid][1], axis, build(items[:mid], depth + 1), build(items[mid + 1:], depth + 1))
+
+    return build(pts, 0)
+
+
+def nearest_in_index(tree, lat, lon, k=3):
+    """[(distância_km, station_id)] dos k mais próximos, por ordem crescente."""
+    q = _xyz(lat, lon)
+    best = []  # max-heap (−d², id)
+
+    def visit(node):
+        if node is None:
+            return
+        p, sid, axis, left, right = node
+        d2 = (q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2 + (q[2] - p[2]) ** 2
+        if len(best) < k:
+            heapq.heappush(best, (-d2, sid))
+        elif d2 < -best[0][0]:
+            heapq.heapreplace(best, (-d2, sid))
+
+        diff = q[axis] - p[axis]
+        near, far = (left, right) if diff < 0 else (right, left)
+        visit(near)
+        if len(best) < k or diff * diff < -best[0][0]:
+            visit(far)
+
+    visit(tree)
+    # corda -> distância ao longo da superfície
+    out = [(2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(-nd2) / 2)), sid) for nd2, sid in best]
+    return sorted(out)
+
+
+def nearest_stations(kind, lat, lon, k=3):
+    """k estações `kind` ("ipma" | "icao") mais próximas de (lat, lon): [(km, id, nome)]."""
+    if kind not in _STATION_INDEX:
+        meta = load_ipma_stations_meta() if kind == "ipma" else load_icao_stations_meta()
+        _STATION_INDEX[kind] = (meta, build_station_index(meta))
+
+    meta, tree = _STATION_INDEX[kind]
+    return [(round(km, 2), sid, (meta.get(sid) or {}).get("name")) for km, sid in nearest_in_index(tree, lat, lon, k)]
+
+
+# =========================
+# File targets (Parquet / CSV / JSONL particionados por fonte=/date=)
+# =========================
+FILE_COLUMNS = ["fonte", "data", "temp", "humidade", "vento", "pressao", "precipitacao", "lugar", "lat", "lon", "extras", "regdata"]
+FILE_NUMERIC = ("temp", "humidade", "vento", "pressao", "precipitacao", "lat", "lon")
+FILE_EXT = {"parquet": ".parquet", "csv": ".csv.gz", "jsonl": ".jsonl.gz"}
+
+
+def _file_partition_dir(h, fonte, ts):
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(fonte))
+    return os.path.join(h["path"], f"fonte={safe}", f"date={ts:%Y-%m-%d}")
+
+
+def file_target_keys(h, fonte, ts):
+    """Índice de chaves da partição: {data_iso: {lugar}} (carregado de _keys.tsv na primeira utilização)."""
+    part = _file_partition_dir(h, fonte, ts)
+    if part not in h["keys"]:
+        index = {}
+        kpath = os.path.join(part, "_keys.tsv")
+        if os.path.exists(kpath):
+            with open(kpath, "r", encoding="utf-8") as f:
+                for line in f:
+                    d, _, lugar = line.rstrip("\n").partition("\t")
+                    index.setdefault(d, set()).add(lugar)
+        h["keys"][part] = index
+    return h["keys"][part]
+
+
+def file_target_append(h, fonte, ts, rows_in):
+    """Bufferiza as linhas novas (escritas de uma vez em file_target_flush) e atualiza o índice."""
+    part = _file_partition_dir(h, fonte, ts)
+    index = file_target_keys(h, fonte, ts)
+    h["buffer"].setdefault(part, []).extend(rows_in)
+    for r in rows_in:
+        index.setdefault(r["data"].isoformat(), set()).add(str(r.get("lugar")))
+
+
+def _file_write(fmt, path, recs):
+    tmp = path + ".tmp"
+    if fmt == "parquet":
+        cols = {}
+        for c in FILE_COLUMNS:
+            vals = [rec.get(c) for rec in recs]
+            if c in ("data", "regdata"):
+                cols[c] = pa.array(vals, type=pa.timestamp("s"))
+            elif c in FILE_NUMERIC:
+                cols[c] = pa.array([float(v) if isinstance(v, (int, float)) else None for v in vals], type=pa.float64())
+            else:
+                cols[c] = pa.array([None if v is None else str(v) for v in vals], type=pa.string())
+        pq.write_table(pa.table(cols), tmp, compression="zstd")
+
+    elif fmt == "csv":
+        with gzip.open(tmp, "wt", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(FILE_COLUMNS)
+            for rec in recs:
+                w.writerow(["" if rec.get(c) is None else rec.get(c) for c in FILE_COLUMNS])
+
+    else:  # jsonl
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for rec in recs:
+                f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+
+    os.replace(tmp, path)
+
+
+def _file_read(fmt, path):
+    if fmt == "parquet":
+        return pq.read_table(path).to_pylist()
+    if fmt == "csv":
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            return list(csv.DictReader(f))
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def file_target_flush(h):
+    """Escreve um ficheiro por partição tocada, anexa as chaves ao índice e compacta partições com muitos ficheiros."""
+    ext = FILE_EXT[h["format"]]
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    stamp = f"{now:%Y%m%dT%H%M%S}-{os.getpid()}"
+    n_files = 0
+
+    for part, buf in h["buffer"].items():
+        if not buf:
+            continue
+        os.makedirs(part, exist_ok=True)
+
+        recs = []
+        for r in buf:
+            rec = {c: r.get(c) for c in FILE_COLUMNS if c not in ("extras", "regdata")}
+            rec["extras"] = r.get("extras") or {}
+            rec["regdata"] = now
+            if h["format"] != "jsonl":
+                rec["extras"] = json.dumps(rec["extras"], ensure_ascii=False, default=str)
+            if h["format"] != "parquet":
+                rec["data"] = rec["data"].strftime("%Y-%m-%d %H:%M:%S")
+                rec["regdata"] = now.strftime("%Y-%m-%d %H:%M:%S")
+            recs.append(rec)
+
+        _file_write(h["format"], os.path.join(part, f"part-{stamp}{ext}"), recs)
+        n_files += 1
+
+        # índice só depois do ficheiro estar no sítio (crash -> no pior caso re-escreve, nunca perde)
+        with open(os.path.join(part, "_keys.tsv"), "a", encoding="utf-8") as f:
+            for r in buf:
+                f.write(f"{r['data'].isoformat()}\t{r.get('lugar')}\n")
+
+        parts = sorted(fn for fn in os.listdir(part) if fn.startswith("part-") and fn.endswith(ext))
+        if len(parts) > h["compact_files"]:
+            merged = []
+            for fn in parts:
+                merged.extend(_file_read(h["format"], os.path.join(part, fn)))
+            if h["format"] == "csv":
+                # DictReader devolve texto; "" -> None para o writer não escrever "None"
+                merged = [{k: (v if v != "" else None) for k, v in rec.items()} for rec in merged]
+            _file_write(h["format"], os.path.join(part, f"part-{stamp}-compact{ext}"), merged)
+            for fn in parts:
+                os.remove(os.path.join(part, fn))
+
+    h["buffer"] = {}
+    return n_files
+
+
+# =========================
+# SQLite target (embebido, sem infraestrutura)
+# =========================
+def _sqlite_ts(v):
+    # datas como texto ISO (ordenável); evita o adapter de datetime por omissão (deprecated em 3.12)
+    return v.strftime("%Y-%m-%d %H:%M:%S") if isinstance(v, datetime) else v
+
+
+def _rollup_bucket(v):
+    # bucket devolvido pelo GROUP BY -> datetime naive UTC (SQLite: texto ISO; CrateDB: epoch ms)
+    if isinstance(v, datetime):
+        return v.astimezone(timezone.utc).replace(tzinfo=None) if v.tzinfo else v
+    if isinstance(v, (int, float)):
+        return datetime.fromtimestamp(v / 1000, tz=timezone.utc).replace(tzinfo=None)
+    return datetime.fromisoformat(str(v))
+
+
+def sqlite_connect(path, table, extras_col, rollups, synchronous="NORMAL", cache_mb=64):
+    """Abre/cria a BD SQLite em WAL, com pragmas de escrita em batch e o schema core + UNIQUE (fonte, data, lugar)."""
+    d = os.path.dirname(os.path.abspath(path))
+    os.makedirs(d, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute(f"PRAGMA cache_size=-{int(cache_mb) * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+    extras_sql = f", {extras_col} TEXT NULL CHECK ({extras_col} IS NULL OR json_valid({extras_col}))" if extras_col else ""
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        " fonte TEXT NOT NULL, data TEXT NOT NULL,"
+        " temp REAL NULL, humidade REAL NULL, vento REAL NULL, pressao REAL NULL, precipitacao REAL NULL,"
+        " lugar TEXT NOT NULL, lat REAL NULL, lon REAL NULL"
+        f"{extras_sql},"
+        " regdata TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    )
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table} ON {table} (fonte, data, lugar)")
+
+    if rollups:
+        for grain in ("hourly", "daily"):
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table}_{grain} ("
+                " fonte TEXT NOT NULL, lugar TEXT NOT NULL, bucket TEXT NOT NULL, n INTEGER NOT NULL,"
+                " temp_min REAL, temp_max REAL, temp_avg REAL, humidade_avg REAL, vento_avg REAL, vento_max REAL,"
+                " pressao_avg REAL, precipitacao_sum REAL, updated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+            )
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_{grain} ON {table}_{grain} (fonte, lugar, bucket)")
+
+    conn.commit()
+    return conn
+
+
+# =========================
+# Profiling (opt-in)
+# =========================
+_PROF = {"stages": {}, "order": [], "active": None, "own_lines": None}
+
+
+def _peak_rss_mb():
+    if not HAS_RESOURCE:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # macOS: bytes, Linux: KB
+
+
+def _prof_own_line(frame):
+    # frames do tracemalloc e dos helpers de profiling (ex.: acumuladores de prof_stop) não entram no top-N;
+    # filtrar as estatísticas agrupadas sai muito mais barato que Snapshot.filter_traces() sobre todos os traces
+    if frame.filename == tracemalloc.__file__:
+        return True
+    if _PROF["own_lines"] is None:
+        _PROF["own_lines"] = {
+            (fn.__code__.co_filename, ln)
+            for fn in (prof_start, prof_stop, prof_annotate, _peak_rss_mb, _prof_exclude, _prof_own_line)
+            for _, _, ln in fn.__code__.co_lines()
+        }
+    return (frame.filename, frame.lineno) in _PROF["own_lines"]
+
+
+def _prof_exclude(w0, p0):
+    # o tempo gasto pelo profiler não entra nos temporizadores PCP (w_prev/p_prev)
+    global w_prev, p_prev
+    w_prev += time.perf_counter() - w0
+    p_prev += time.process_time() - p0
+
+
+def prof_start(stage):
+    """Liga cProfile + pico tracemalloc para `stage` (chamadas repetidas acumulam na mesma etapa)."""
+    if not PROFILE:
+        return
+    if _PROF["active"] is not None:
+        # etapa anterior interrompida por exceção
+        prof_stop(_PROF["active"])
+    w0, p0 = time.perf_counter(), time.process_time()
+
+    st = _PROF["stages"].get(stage)
+    if st is None:
+        st = {"profile": cProfile.Profile(), "snap0": None, "alloc": {}, "intervals": 0, "sampled": 0, "peak": 0}
+        _PROF["stages"][stage] = st
+        _PROF["order"].append(stage)
+
+    # snapshots só nos primeiros PROFILE_ALLOC_INTERVALS intervalos; os restantes ficam por reset_peak/get_traced_memory
+    st["intervals"] += 1
+    st["snap0"] = tracemalloc.take_snapshot() if st["sampled"] < PROFILE_ALLOC_INTERVALS else None
+
+    tracemalloc.reset_peak()
+    _PROF["active"] = stage
+    _prof_exclude(w0, p0)
+    st["profile"].enable()
+
+
+def prof_stop(stage, step=None):
+    """Desliga o profiling de `stage`; se `step` for dado, junta-lhe o pico de RSS/tracemalloc (colunas PCP)."""
+    if not PROFILE:
+        return
+    st = _PROF["stages"].get(stage)
+    if st is None or _PROF["active"] != stage:
+        return
+
+    st["profile"].disable()
+    w0, p0 = time.perf_counter(), time.process_time()
+    _PROF["active"] = None
+    st["peak"] = max(st["peak"], tracemalloc.get_traced_memory()[1])
+
+    if st["snap0"] is not None:
+        # soma as diferenças deste intervalo -> etapas alternadas (dedup/insert) não se misturam
+        for stat in tracemalloc.take_snapshot().compare_to(st["snap0"], "lineno"):
+            if _prof_own_line(stat.traceback[0]):
+                continue
+            acc = st["alloc"].setdefault(stat.traceback[0], [0, 0])
+            acc[0] += stat.size_diff
+            acc[1] += stat.count_diff
+        st["snap0"] = None
+        st["sampled"] += 1
+
+    if step is not None:
+        prof_annotate(step, stage)
+    _prof_exclude(w0, p0)
+
+
+def prof_annotate(step, *stages):
+    if not PROFILE:
+        return
+    peaks = [_PROF["stages"][s]["peak"] for s in stages if s in _PROF["stages"]]
+    step["rss_mb"] = _peak_rss_mb()
+    step["traced_mb"] = max(peaks) / (1024 * 1024) if peaks else None
+
+
+def prof_dump():
+    """Escreve <PROFILE_DIR>/<timestamp>/NN_<etapa>.prof e .alloc.txt (top-N alocações). Devolve a pasta."""
+    if not PROFILE or not _PROF["order"]:
+        return None
+    if _PROF["active"] is not None:
+        prof_stop(_PROF["active"])
+
+    out_dir = os.path.join(PROFILE_DIR, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"))
+    os.makedirs(out_dir, exist_ok=True)
+
+    for i, stage in enumerate(_PROF["order"], start=1):
+        st = _PROF["stages"][stage]
+        slug = re.sub(r"\W+", "_", stage).strip("_")
+        base = os.path.join(out_dir, f"{i:02d}_{slug}")
+        st["profile"].dump_stats(base + ".prof")
+
+        with open(base + ".alloc.txt", "w", encoding="utf-8") as f:
+            f.write(f"stage: {stage}\n")
+            f.write(f"peak traced memory: {st['peak'] / (1024 * 1024):.2f} MB\n")
+            rss = _peak_rss_mb()
+            if rss is not None:
+                f.write(f"peak RSS (processo, até ao fim da execução): {rss:.1f} MB\n")
+            f.write(
+                f"\ntop {PROFILE_TOP_N} alocações (soma das diferenças início -> fim em "
+                f"{st['sampled']} de {st['intervals']} intervalo(s) da etapa):\n"
+            )
+            top = sorted(
+                ((fr, d) for fr, d in st["alloc"].items() if d[0] or d[1]), key=lambda kv: abs(kv[1][0]), reverse=True
+            )[:PROFILE_TOP_N]
+            for frame, (size_diff, count_diff) in top:
+                f.write(f"{frame.filename}:{frame.lineno}: size={size_diff / 1024:+.1f} KiB, count={count_diff:+d}\n")
+
+    return out_dir
+
+
+# =========================
+# Run history (SQLite) + regressões
+# =========================
+def _history_connect(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS runs ("
+        " run_id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT NOT NULL, pipeline TEXT NOT NULL, env TEXT NOT NULL,"
+        " provider TEXT NOT NULL, ok INTEGER NOT NULL, total_watch REAL NOT NULL, total_proc REAL NOT NULL, errors TEXT,"
+        " profiled INTEGER NOT NULL DEFAULT 0)"
+    )
+    if "profiled" not in [c[1] for c in conn.execute("PRAGMA table_info(runs)")]:
+        conn.execute("ALTER TABLE runs ADD COLUMN profiled INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS run_steps ("
+        " run_id INTEGER NOT NULL, stage TEXT NOT NULL, target TEXT NOT NULL, watch REAL NOT NULL, proc REAL NOT NULL,"
+        " rows INTEGER NULL, inserted INTEGER NULL, skipped INTEGER NULL, status TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_run_steps ON run_steps (stage, target, run_id)")
+    return conn
+
+
+def _stage_totals(steps_in):
+    """Soma os steps por (stage, target): {(stage, target): {"watch", "proc", "rows", "inserted", "skipped", "status"}}."""
+    out = {}
+    for r in steps_in:
+        if not r.get("stage"):
+            continue
+        key = (r["stage"], str(r.get("target") or ""))
+        agg = out.setdefault(key, {"watch": 0.0, "proc": 0.0, "rows": None, "inserted": None, "skipped": None, "status": ""})
+        agg["watch"] += r["watch"]
+        agg["proc"] += r["proc"]
+        for c in ("rows", "inserted", "skipped"):
+            if r.get(c) is not None:
+                agg[c] = (agg[c] or 0) + r[c]
+        if r.get("status"):
+            agg["status"] = r["status"]
+    return out
+
+
+def history_baseline(conn, pipeline, env, provider):
+    """Mediana/p95 de watch e mediana de throughput (linhas/s) por (stage, target) nas últimas execuções OK (sem profiling)."""
+    run_ids = [rr[0] for rr in conn.execute(
+        "SELECT run_id FROM runs WHERE ok=1 AND profiled=0 AND pipeline=? AND env=? AND provider=? ORDER BY run_id DESC LIMIT ?",
+        (pipeline, env, provider, HISTORY_WINDOW),
+    )]
+    if not run_ids:
+        return {}
+
+    samples = {}
+    q = f"SELECT stage, target, watch, rows FROM run_steps WHERE status='' AND run_id IN ({', '.join('?' * len(run_ids))})"
+    for stage, target, watch, nrows in conn.execute(q, run_ids):
+        sm = samples.setdefault((stage, target), {"watch": [], "tput": []})
+        sm["watch"].append(watch)
+        if nrows and watch > 0:
+            sm["tput"].append(nrows / watch)
+
+    base = {}
+    for key, sm in samples.items():
+        w = sorted(sm["watch"])
+        base[key] = {
+            "n": len(w),
+            "median": statistics.median(w),
+            "p95": w[max(0, math.ceil(0.95 * len(w)) - 1)],
+            "tput_median": statistics.median(sm["tput"]) if sm["tput"] else None,
+        }
+    return base
+
+
+def history_check(totals, base):
+    """Etapas cuja latência ou throughput se afasta da baseline: [{"stage", "target", "watch", "median", "p95", "reason"}]."""
+    out = []
+    for (stage, target), cur in totals.items():
+        b = base.get((stage, target))
+        if not b or b["n"] < HISTORY_MIN_RUNS or cur["status"]:
+            continue
+        # diferença absoluta mínima: etapas de milissegundos não contam
+        if cur["watch"] - b["median"] < REGRESSION_MIN_SECS:
+            continue
+
+        reason = None
+        if cur["watch"] > max(b["p95"], b["median"] * REGRESSION_FACTOR):
+            reason = "latência"
+        elif cur["rows"] and b["tput_median"] and cur["watch"] > 0 and cur["rows"] / cur["watch"] < b["tput_median"] / REGRESSION_FACTOR:
+            reason = "throughput"
+
+        if reason:
+            out.append({"stage": stage, "target": target, "watch": cur["watch"], "median": b["median"], "p95": b["p95"], "reason": reason})
+    return out
+
+
+def history_update(steps_in, ok, errs, pipeline, env, provider):
+    """Compara a execução com a baseline (antes de a gravar) e acrescenta-a ao histórico. Devolve as regressões."""
+    totals = _stage_totals(steps_in)
+    conn = _history_connect(HISTORY_DB)
+    try:
+        # com profiling os tempos vêm inflacionados: grava-se, mas não entra na baseline nem é avaliado
+        regressions = history_check(totals, history_baseline(conn, pipeline, env, provider)) if ok and not PROFILE else []
+
+        with conn:
+            cur = conn.execute(
+                "INSERT INTO runs (started, pipeline, env, provider, ok, total_watch, total_proc, errors, profiled) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), pipeline, env, provider, 1 if ok else 0,
+                    sum(r["watch"] for r in steps_in), sum(r["proc"] for r in steps_in),
+                    json.dumps(errs, ensure_ascii=False) if errs else None, 1 if PROFILE else 0,
+                ),
+            )
+            run_id = cur.lastrowid
+            conn.executemany(
+                "INSERT INTO run_steps (run_id, stage, target, watch, proc, rows, inserted, skipped, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, stage, target, t["watch"], t["proc"], t["rows"], t["inserted"], t["skipped"], t["status"])
+                 for (stage, target), t in totals.items()],
+            )
+        return regressions
+    finally:
+        conn.close()
+
+
+# =========================
+# CLI modes (não correm a pipeline)
+# =========================
+if "--flush-outbox" in sys.argv[1:]:
+    n_sent = outbox_flush()
+    print(f"Outbox: {n_sent} email(s) enviado(s).")
+    sys.exit(0)
+
+if "--nearest" in sys.argv[1:]:
+    # python main.py --nearest LAT LON [K]
+    _args = sys.argv[sys.argv.index("--nearest") + 1:]
+    if len(_args) < 2:
+        raise ValueError("Uso: python main.py --nearest LAT LON [K]")
+    _k = int(_args[2]) if len(_args) > 2 else NEAREST_K
+    for _kind in ("ipma", "icao"):
+        for km, sid, nm in nearest_stations(_kind, float(_args[0]), float(_args[1]), _k):
+            print(f"{_kind.upper():5} {sid:10} {km:8.2f} km  {nm or ''}")
+    sys.exit(0)
+
+if "--serve-latest" in sys.argv[1:]:
+    if not LATEST_DB:
+        raise ValueError("PIPELINE_LATEST_DB vazio: snapshot de últimas observações desligado.")
+    serve_latest(LATEST_HTTP_HOST, LATEST_HTTP_PORT)
+    sys.exit(0)
+
 
 API_PROVIDER = (os.getenv("PIPELINE_API_PROVIDER") or "").strip().lower()
 if API_PROVIDER not in ("weatherbit", "ipma", "icao"):
@@ -77,6 +1130,12 @@ WEATHERBIT_URL = f"https://api.weatherbit.io/v2.0/current?city={WEATHERBIT_CITY}
 IPMA_URL = "https://api.ipma.pt/open-data/observation/meteorology/stations/observations.json"
 
 ICAO_CODE = (os.getenv("ICAO_CODE") or "").strip().upper()
+
+# ponto de interesse -> estações mais próximas (só quando a lista não está definida à mão);
+# resolvido já dentro da execução (etapa "nearest") para as falhas passarem pelo relatório
+NEAREST_RESOLVE = NEAREST_LAT is not None and NEAREST_LON is not None and (
+    (API_PROVIDER == "ipma" and not IPMA_STATION_IDS) or (API_PROVIDER == "icao" and not ICAO_CODE)
+)
 ICAO_URL = f"https://aviationweather.gov/api/data/metar?ids={ICAO_CODE}&format=json"
 
 API_URL_OVERRIDE = (os.getenv("PIPELINE_API_URL") or "").strip()
@@ -90,8 +1149,8 @@ elif API_PROVIDER == "ipma":
     API_URL = API_URL_OVERRIDE or IPMA_URL
 
 else:  # icao
-    if not ICAO_CODE:
-        raise ValueError("PIPELINE_API_PROVIDER=icao mas falta ICAO_CODE (ex: LPPR)")
+    if not ICAO_CODE and not NEAREST_RESOLVE:
+        raise ValueError("PIPELINE_API_PROVIDER=icao mas falta ICAO_CODE (ex: LPPR) ou PIPELINE_NEAREST_LAT/LON")
     API_URL = API_URL_OVERRIDE or ICAO_URL
 
 
@@ -100,6 +1159,9 @@ DASHBOARD_URL = os.getenv("PIPELINE_DASHBOARD_URL_METEO", "")
 
 SQL_EXTRAS_COLUMN_DEFAULT = (os.getenv("PIPELINE_SQL_EXTRAS_COLUMN") or "").strip()
 
+# Rollups horários/diários (<table>_hourly / <table>_daily); override por target com "rollups": true/false
+ROLLUPS_DEFAULT = (os.getenv("PIPELINE_ROLLUPS") or "0").strip().lower() in ("1", "true", "yes")
+
 
 ctx = {
     "pipeline_name": PIPELINE_NAME,
@@ -128,11 +1190,44 @@ p_prev = time.process_time()
 extra_lines = []
 handles = {}
 errors = {}
+pipeline_ok = False
+
+if PROFILE:
+    tracemalloc.start()
 
 try:
+    # =========================
+    # 0) Nearest stations (opcional)
+    # =========================
+    if NEAREST_RESOLVE:
+        prof_start("nearest")
+        near = nearest_stations(API_PROVIDER, NEAREST_LAT, NEAREST_LON, NEAREST_K)
+        if not near:
+            raise ValueError(f"Resolver sem estações {API_PROVIDER.upper()} (metadados vazios).")
+
+        if API_PROVIDER == "ipma":
+            IPMA_STATION_IDS = {sid for _, sid, _ in near}
+            label = f"Nearest IPMA stations: {', '.join(sorted(IPMA_STATION_IDS))}"
+        else:
+            ICAO_CODE = ",".join(sid for _, sid, _ in near)
+            ctx["icao_code"] = ICAO_CODE
+            if not API_URL_OVERRIDE:
+                ctx["api_url"] = f"https://aviationweather.gov/api/data/metar?ids={ICAO_CODE}&format=json"
+            label = f"Nearest ICAO aerodromes: {ICAO_CODE}"
+
+        w_now = time.perf_counter()
+        p_now = time.process_time()
+        watch = w_now - w_prev
+        proc = p_now - p_prev
+        w_prev = w_now
+        p_prev = p_now
+        steps.append({'step': str(label), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'nearest'})
+        prof_stop("nearest", steps[-1])
+
     # =========================
     # 1) Request data
     # =========================
+    prof_start("fetch")
     resp = requests.get(ctx["api_url"], timeout=20)
     resp.raise_for_status()
     json_data = resp.json()
@@ -143,7 +1238,7 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str("Data request successful!"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str("Data request successful!"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'request'})
 
     if not json_data:
         raise ValueError("JSON vazio ou inválido")
@@ -155,11 +1250,13 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str("Data reception successful!"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str("Data reception successful!"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'reception'})
+    prof_stop("fetch", steps[-1])
 
     # =========================
     # 2) Parse to canonical rows
     # =========================
+    prof_start("parse")
     rows = []
 
     if API_PROVIDER == "weatherbit":
@@ -207,10 +1304,40 @@ try:
                 },
         })
 
+        # estações IPMA/ICAO mais próximas do ponto Weatherbit (opcional)
+        if NEAREST_ANNOTATE and obs.get("lat") is not None and obs.get("lon") is not None:
+            try:
+                for kind in ("ipma", "icao"):
+                    near = nearest_stations(kind, obs["lat"], obs["lon"], NEAREST_K)
+                    rows[-1]["extras"][f"nearest_{kind}"] = [sid for _, sid, _ in near]
+            except Exception as e:
+                print(f"Falha no resolver de estações mais próximas: {e}")
+
     elif API_PROVIDER == "ipma":
         if not isinstance(received, dict):
             raise ValueError("Resposta IPMA inesperada (esperado dict {timestamp:{station:{...}}}).")
 
+        stations_meta = {}
+        if IPMA_FETCH_STATIONS_META:
+            try:
+                stations_meta = load_ipma_stations_meta()
+                status = ''
+                label = f"IPMA station meta ({len(stations_meta)} estações)"
+            except Exception as e:
+                # segue sem lat/lon, mas a execução conta como falhada (histórico, política de email)
+                errors["ipma_meta"] = str(e)
+                extra_lines.append(f"Metadados IPMA indisponíveis (linhas sem lat/lon): {e}")
+                status = "FAIL"
+                label = f"IPMA station meta failed: {e}"
+
+            w_now = time.perf_counter()
+            p_now = time.process_time()
+            watch = w_now - w_prev
+            proc = p_now - p_prev
+            w_prev = w_now
+            p_prev = p_now
+            steps.append({'step': str(label), 'status': str(status), 'watch': float(watch), 'proc': float(proc), 'stage': 'ipma_meta'})
+
         for timestamp, stations in received.items():
             if not isinstance(stations, dict):
                 continue
@@ -238,8 +1365,16 @@ try:
                 ts_dt = datetime.now(timezone.utc)
 
             for station_id, values in stations.items():
+                station_id = str(station_id)
+                # filtro aplicado aqui: estações fora da lista nunca chegam a linhas/dedup/insert
+                if IPMA_STATION_IDS and station_id not in IPMA_STATION_IDS:
+                    continue
                 if not isinstance(values, dict):
                     continue
+
+                meta = stations_meta.get(station_id) or {}
+                station_name = IPMA_STATION_NAMES.get(station_id) or meta.get("name")
+
                 rows.append({
                     "fonte": "IPMA",
                     "data": ts_dt,
@@ -248,112 +1383,113 @@ try:
                     "vento": values.get("intensidadeVento"),
                     "pressao": values.get("pressao"),
                     "precipitacao": values.get("precAcumulada"),
-                    "lugar": str(station_id),
-                    "lat": None,
-                    "lon": None,
-                    "extras": {}
+                    "lugar": station_id,
+                    "lat": meta.get("lat"),
+                    "lon": meta.get("lon"),
+                    "extras": {"station_name": station_name} if station_name else {}
                 })
 
     elif API_PROVIDER == "icao":
-        # AWC METAR normalmente retorna LISTA de dicts
-        item = None
-        if isinstance(received, list) and received and isinstance(received[0], dict):
-            item = received[0]
+        # AWC METAR normalmente retorna LISTA de dicts (uma por ICAO pedido)
+        items = []
+        if isinstance(received, list):
+            items = [it for it in received if isinstance(it, dict)]
         elif isinstance(received, dict):
-            item = received
+            items = [received]
 
-        if not isinstance(item, dict):
+        if not items:
             raise ValueError("Resposta ICAO inesperada (esperado list[dict] ou dict).")
 
-        raw = (item.get("rawOb") or item.get("raw") or item.get("metar") or "").strip()
+        single_code = ICAO_CODE if "," not in ICAO_CODE else ""
 
-        # timestamp best-effort
-        dt = None
-        for k in ("obsTime", "reportTime", "validTime", "time"):
-            v = item.get(k)
-            if v:
-                s = str(v).strip()
-                if s.endswith("Z"):
-                    s = s[:-1] + "+00:00"
-                try:
-                    dt = datetime.fromisoformat(s)
-                    break
-                except Exception:
-                    dt = None
-        if dt is None:
-            dt = datetime.now(timezone.utc)
+        for item in items:
+            raw = (item.get("rawOb") or item.get("raw") or item.get("metar") or "").strip()
 
-        # temp / dewpoint best-effort
-        temp = item.get("tempC") if item.get("tempC") is not None else item.get("temp")
-        dew = item.get("dewpointC") if item.get("dewpointC") is not None else item.get("dewp")
-
-        import re
-        if (temp is None or dew is None) and raw:
-            m = re.search(r"\b(M?\d{2})/(M?\d{2})\b", raw)
-            if m:
-                def _t(x):
-                    return -int(x[1:]) if x.startswith("M") else int(x)
-                if temp is None:
-                    temp = _t(m.group(1))
-                if dew is None:
-                    dew = _t(m.group(2))
-
-        # wind best-effort (knots -> m/s)
-        wind_dir = item.get("wdir")
-        wind_kt = item.get("wspd") if item.get("wspd") is not None else item.get("windSpeedKt")
-        if wind_kt is None and raw:
-            m = re.search(r"\b(\d{3}|VRB)(\d{2,3})KT\b", raw)
-            if m:
-                wind_dir = None if m.group(1) == "VRB" else int(m.group(1))
-                wind_kt = int(m.group(2))
-
-        wind_ms = None
-        if wind_kt is not None:
-            try:
-                wind_ms = float(wind_kt) * 0.514444
-            except Exception:
-                wind_ms = None
-
-        # pressure best-effort: Q1013 or A2992
-        press_hpa = None
-        if raw:
-            mq = re.search(r"\bQ(\d{4})\b", raw)
-            if mq:
-                press_hpa = float(mq.group(1))
-            ma = re.search(r"\bA(\d{4})\b", raw)
-            if press_hpa is None and ma:
-                press_hpa = (float(ma.group(1)) / 100.0) * 33.8638866667
-
-        # humidity from temp + dewpoint (optional)
-        hum = None
-        if temp is not None and dew is not None:
-            try:
-                import math
-                es = math.exp((17.625 * float(dew)) / (243.04 + float(dew)))
-                et = math.exp((17.625 * float(temp)) / (243.04 + float(temp)))
-                hum = round(100.0 * (es / et), 1)
-            except Exception:
-                hum = None
+            # timestamp best-effort
+            dt = None
+            for k in ("obsTime", "reportTime", "validTime", "time"):
+                v = item.get(k)
+                if v:
+                    s = str(v).strip()
+                    if s.endswith("Z"):
+                        s = s[:-1] + "+00:00"
+                    try:
+                        dt = datetime.fromisoformat(s)
+                        break
+                    except Exception:
+                        dt = None
+            if dt is None:
+                dt = datetime.now(timezone.utc)
 
-        rows.append({
-            "fonte": "ICAO",
-            "data": dt,
-            "temp": temp,
-            "humidade": hum,
-            "vento": wind_ms,
-            "pressao": press_hpa,
-            "precipitacao": None,
-            "lugar": ICAO_CODE or item.get("icaoId") or item.get("station") or "UNKNOWN",
-            "lat": item.get("lat") or item.get("latitude"),
-            "lon": item.get("lon") or item.get("longitude"),
-            "extras": {
-                "raw_metar": raw,
-                "dewpoint_c": dew,
-                "wind_dir": wind_dir,
-                "wind_speed_kt": wind_kt,
-            },
+            # temp / dewpoint best-effort
+            temp = item.get("tempC") if item.get("tempC") is not None else item.get("temp")
+            dew = item.get("dewpointC") if item.get("dewpointC") is not None else item.get("dewp")
+
+            if (temp is None or dew is None) and raw:
+                m = re.search(r"\b(M?\d{2})/(M?\d{2})\b", raw)
+                if m:
+                    def _t(x):
+                        return -int(x[1:]) if x.startswith("M") else int(x)
+                    if temp is None:
+                        temp = _t(m.group(1))
+                    if dew is None:
+                        dew = _t(m.group(2))
+
+            # wind best-effort (knots -> m/s)
+            wind_dir = item.get("wdir")
+            wind_kt = item.get("wspd") if item.get("wspd") is not None else item.get("windSpeedKt")
+            if wind_kt is None and raw:
+                m = re.search(r"\b(\d{3}|VRB)(\d{2,3})KT\b", raw)
+                if m:
+                    wind_dir = None if m.group(1) == "VRB" else int(m.group(1))
+                    wind_kt = int(m.group(2))
+
+            wind_ms = None
+            if wind_kt is not None:
+                try:
+                    wind_ms = float(wind_kt) * 0.514444
+                except Exception:
+                    wind_ms = None
+
+            # pressure best-effort: Q1013 or A2992
+            press_hpa = None
+            if raw:
+                mq = re.search(r"\bQ(\d{4})\b", raw)
+                if mq:
+                    press_hpa = float(mq.group(1))
+                ma = re.search(r"\bA(\d{4})\b", raw)
+                if press_hpa is None and ma:
+                    press_hpa = (float(ma.group(1)) / 100.0) * 33.8638866667
+
+            # humidity from temp + dewpoint (optional)
+            hum = None
+            if temp is not None and dew is not None:
+                try:
+                    es = math.exp((17.625 * float(dew)) / (243.04 + float(dew)))
+                    et = math.exp((17.625 * float(temp)) / (243.04 + float(temp)))
+                    hum = round(100.0 * (es / et), 1)
+                except Exception:
+                    hum = None
+
+            rows.append({
+                "fonte": "ICAO",
+                "data": dt,
+                "temp": temp,
+                "humidade": hum,
+                "vento": wind_ms,
+                "pressao": press_hpa,
+                "precipitacao": None,
+                "lugar": single_code or item.get("icaoId") or item.get("station") or "UNKNOWN",
+                "lat": item.get("lat") or item.get("latitude"),
+                "lon": item.get("lon") or item.get("longitude"),
+                "extras": {
+                    "raw_metar": raw,
+                    "dewpoint_c": dew,
+                    "wind_dir": wind_dir,
+                    "wind_speed_kt": wind_kt,
+                },
 
-        })
+            })
 
     else:
         raise ValueError(f"API_PROVIDER inválido: {API_PROVIDER!r}")
@@ -367,10 +1503,12 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str(f"Parsing ({len(rows)} linhas)"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str(f"Parsing ({len(rows)} linhas)"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'parse', 'rows': len(rows)})
+    prof_stop("parse", steps[-1])
     # =========================
     # 3) Normalize timestamps (UTC naive, no microseconds)
     # =========================
+    prof_start("normalize")
     for r in rows:
         v = r.get("data")
         dt = None
@@ -413,12 +1551,14 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str("Normalize timestamps"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str("Normalize timestamps"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'normalize'})
+    prof_stop("normalize", steps[-1])
 
 
     # =========================
     # 4) Load DB targets
     # =========================
+    prof_start("load targets")
     path = ctx["db_targets_file"]
     if not path or not os.path.exists(path):
         raise ValueError(f"Ficheiro de targets não  encontrado: {path!r}")
@@ -453,12 +1593,17 @@ try:
                 extras_col = SQL_EXTRAS_COLUMN_DEFAULT
             extras_col = (extras_col or "").strip()
 
+            rollups = t.get("rollups")
+            if rollups is None:
+                rollups = ROLLUPS_DEFAULT
+
             targets.append({
                 "name": name,
                 "type": "postgres" if ttype != "cratedb" else "cratedb",
                 "dsn": dsn,
                 "table": table,
-                "extras_column": extras_col
+                "extras_column": extras_col,
+                "rollups": bool(rollups)
             })
 
         elif ttype in ("mysql", "mariadb", "tidb", "tidbcloud"):
@@ -475,7 +1620,11 @@ try:
                 extras_col = SQL_EXTRAS_COLUMN_DEFAULT
             extras_col = (extras_col or "").strip()
 
-            targets.append({"name": name, "type": "mysql", "dsn": dsn, "table": table, "extras_column": extras_col})
+            rollups = t.get("rollups")
+            if rollups is None:
+                rollups = ROLLUPS_DEFAULT
+
+            targets.append({"name": name, "type": "mysql", "dsn": dsn, "table": table, "extras_column": extras_col, "rollups": bool(rollups)})
 
         elif ttype in ("mongodb", "mongo"):
             uri = (t.get("uri") or "").strip()
@@ -485,7 +1634,54 @@ try:
             database = (t.get("database") or "meteo").strip()
             collection = (t.get("collection") or "meteo").strip()
 
-            targets.append({"name": name, "type": "mongodb", "uri": uri, "database": database, "collection": collection})
+            rollups = t.get("rollups")
+            if rollups is None:
+                rollups = ROLLUPS_DEFAULT
+
+            targets.append({"name": name, "type": "mongodb", "uri": uri, "database": database, "collection": collection, "rollups": bool(rollups)})
+
+        elif ttype == "sqlite":
+            dbpath = (t.get("path") or "").strip()
+            if not dbpath and isinstance(t.get("path_env"), str) and t["path_env"].strip():
+                dbpath = os.getenv(t["path_env"].strip(), "").strip()
+            dbpath = dbpath or "meteo.sqlite"
+
+            table = (t.get("table") or "meteo").strip()
+            if not table or not all(c.isalnum() or c == "_" for c in table):
+                raise ValueError(f"Nome de tabela inválido: {table!r}")
+
+            extras_col = t.get("extras_column")
+            if extras_col is None:
+                extras_col = SQL_EXTRAS_COLUMN_DEFAULT
+            extras_col = (extras_col or "").strip()
+            if extras_col and not all(c.isalnum() or c == "_" for c in extras_col):
+                raise ValueError(f"extras_column inválido: {extras_col!r}")
+
+            synchronous = (t.get("synchronous") or "NORMAL").strip().upper()
+            if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+                raise ValueError(f"synchronous inválido ({name}): {synchronous!r}")
+
+            rollups = t.get("rollups")
+            if rollups is None:
+                rollups = ROLLUPS_DEFAULT
+
+            targets.append({"name": name, "type": "sqlite", "path": dbpath, "table": table, "extras_column": extras_col,
+                            "synchronous": synchronous, "cache_mb": int(t.get("cache_mb") or 64), "rollups": bool(rollups)})
+
+        elif ttype in ("file", "parquet", "csv", "jsonl"):
+            base = (t.get("path") or "").strip()
+            if not base and isinstance(t.get("path_env"), str) and t["path_env"].strip():
+                base = os.getenv(t["path_env"].strip(), "").strip()
+            base = base or "archive"
+
+            fmt = (t.get("format") or (ttype if ttype != "file" else "")).strip().lower()
+            if not fmt:
+                fmt = "parquet" if HAS_PYARROW else "jsonl"
+            if fmt not in FILE_EXT:
+                raise ValueError(f"Formato de ficheiro inválido ({name}): {fmt!r} (parquet | csv | jsonl)")
+
+            targets.append({"name": name, "type": "file", "path": base, "format": fmt,
+                            "compact_files": int(t.get("compact_files") or 8)})
 
         else:
             raise ValueError(f"Tipo de target desconhecido ({name}): {ttype!r}")
@@ -496,18 +1692,20 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str(f"Load DB targets ({len(targets)})"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str(f"Load DB targets ({len(targets)})"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'load_targets'})
+    prof_stop("load targets", steps[-1])
 
     # =========================
     # 5) Connect targets
     # =========================
+    prof_start("connect")
     w_now = time.perf_counter()
     p_now = time.process_time()
     watch = w_now - w_prev
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str("Starting database accesses:"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str("Starting database accesses:"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'connect_start'})
 
     for t in targets:
         name = t["name"]
@@ -525,7 +1723,8 @@ try:
                     "type": ttype,
                     "conn": conn,
                     "table": t["table"],
-                    "extras_column": t.get("extras_column", "")
+                    "extras_column": t.get("extras_column", ""),
+                    "rollups": t.get("rollups", False)
                 }
 
 
@@ -562,7 +1761,8 @@ try:
                     "conn": conn,
                     "table": t["table"],
                     "driver": driver,
-                    "extras_column": t.get("extras_column", "")
+                    "extras_column": t.get("extras_column", ""),
+                    "rollups": t.get("rollups", False)
                 }
 
             elif ttype == "mongodb":
@@ -573,7 +1773,31 @@ try:
                     raise RuntimeError("MongoDB URI vazio (uri/uri_env).")
                 client = MongoClient(uri)
                 col = client[t["database"]][t["collection"]]
-                handles[name] = {"type": "mongodb", "client": client, "col": col}
+                handles[name] = {"type": "mongodb", "client": client, "col": col, "rollups": t.get("rollups", False)}
+
+            elif ttype == "sqlite":
+                conn = sqlite_connect(t["path"], t["table"], t["extras_column"], t["rollups"],
+                                      synchronous=t["synchronous"], cache_mb=t["cache_mb"])
+                handles[name] = {
+                    "type": "sqlite",
+                    "conn": conn,
+                    "table": t["table"],
+                    "extras_column": t["extras_column"],
+                    "rollups": t["rollups"]
+                }
+
+            elif ttype == "file":
+                if t["format"] == "parquet" and not HAS_PYARROW:
+                    raise RuntimeError("pyarrow não instalado (pip install pyarrow) - usar format csv/jsonl.")
+                os.makedirs(t["path"], exist_ok=True)
+                handles[name] = {
+                    "type": "file",
+                    "path": t["path"],
+                    "format": t["format"],
+                    "compact_files": t["compact_files"],
+                    "keys": {},
+                    "buffer": {}
+                }
 
             else:
                 raise RuntimeError(f"type não suportado: {ttype}")
@@ -584,7 +1808,7 @@ try:
             proc = p_now - p_prev
             w_prev = w_now
             p_prev = p_now
-            steps.append({'step': str(f"... connected to `{name}`"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+            steps.append({'step': str(f"... connected to `{name}`"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'connect', 'target': name})
 
         except Exception as e:
             errors[name] = str(e)
@@ -594,11 +1818,14 @@ try:
             proc = p_now - p_prev
             w_prev = w_now
             p_prev = p_now
-            steps.append({'step': str(f"... failed to connect to `{name}`: {e}"), 'status': str("FAIL"), 'watch': float(watch), 'proc': float(proc)})
+            steps.append({'step': str(f"... failed to connect to `{name}`: {e}"), 'status': str("FAIL"), 'watch': float(watch), 'proc': float(proc), 'stage': 'connect', 'target': name})
+
+    prof_stop("connect", steps[-1])
 
     extra_lines.append(f"Targets ligados: {', '.join(handles.keys()) if handles else '(nenhum)'}")
-    if errors:
-        extra_lines.append("Targets com erro: " + "; ".join([f"{k}={v}" for k, v in errors.items()]))
+    target_errors = {k: v for k, v in errors.items() if any(t["name"] == k for t in targets)}
+    if target_errors:
+        extra_lines.append("Targets com erro: " + "; ".join([f"{k}={v}" for k, v in target_errors.items()]))
 
 
 
@@ -608,6 +1835,20 @@ try:
 
     COLUMNS = ["fonte", "data", "temp", "humidade", "vento", "pressao", "precipitacao", "lugar", "lat", "lon"]
 
+    # rollups: (nome, agregação SQL, agregação Mongo)
+    ROLLUP_FIELDS = [
+        ("n", "COUNT(*)", {"$sum": 1}),
+        ("temp_min", "MIN(temp)", {"$min": "$temp"}),
+        ("temp_max", "MAX(temp)", {"$max": "$temp"}),
+        ("temp_avg", "AVG(temp)", {"$avg": "$temp"}),
+        ("humidade_avg", "AVG(humidade)", {"$avg": "$humidade"}),
+        ("vento_avg", "AVG(vento)", {"$avg": "$vento"}),
+        ("vento_max", "MAX(vento)", {"$max": "$vento"}),
+        ("pressao_avg", "AVG(pressao)", {"$avg": "$pressao"}),
+        ("precipitacao_sum", "SUM(precipitacao)", {"$sum": "$precipitacao"}),
+    ]
+    ROLLUP_GRAINS = [("hourly", timedelta(hours=1)), ("daily", timedelta(days=1))]
+
     # group rows by (fonte, timestamp)
     batches = {}
     for r in rows:
@@ -625,15 +1866,17 @@ try:
     proc = p_now - p_prev
     w_prev = w_now
     p_prev = p_now
-    steps.append({'step': str(f"Batching por fonte+timestamp ({len(batches)} batches)"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+    steps.append({'step': str(f"Batching por fonte+timestamp ({len(batches)} batches)"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'batching', 'rows': len(rows)})
 
     for target_name, h in handles.items():
         inserted = 0
         skipped = 0
+        touched = set()  # (fonte, lugar, data) inseridos -> buckets a recalcular
 
         for (fonte, ts), batch_rows in batches.items():
 
             # get existing lugares for (fonte, ts)
+            prof_start(f"dedup @ {target_name}")
             if h["type"] == "mongodb":
                 q = {"fonte": fonte, "data": ts}
                 docs = h["col"].find(q, {"lugar": 1, "_id": 0})
@@ -641,6 +1884,11 @@ try:
                 for d in docs:
                     if d.get("lugar") is not None:
                         existing_lugares.add(str(d.get("lugar")))
+            elif h["type"] == "file":
+                existing_lugares = set(file_target_keys(h, fonte, ts).get(ts.isoformat(), ()))
+            elif h["type"] == "sqlite":
+                rs = h["conn"].execute(f"SELECT lugar FROM {h['table']} WHERE fonte=? AND data=?", (fonte, _sqlite_ts(ts))).fetchall()
+                existing_lugares = {str(rr[0]) for rr in rs if rr[0] is not None}
             else:
                 table = h["table"]
                 conn = h["conn"]
@@ -661,12 +1909,14 @@ try:
             for r in batch_rows:
                 if str(r.get("lugar")) not in existing_lugares:
                     to_insert.append(r)
+            prof_stop(f"dedup @ {target_name}")
 
             skipped += (len(batch_rows) - len(to_insert))
             if not to_insert:
                 continue
 
             # insert
+            prof_start(f"insert @ {target_name}")
             if h["type"] == "mongodb":
                 now = datetime.now(timezone.utc).replace(tzinfo=None)
                 docs = []
@@ -676,6 +1926,22 @@ try:
                     docs.append(d)
                 h["col"].insert_many(docs, ordered=False)
 
+            elif h["type"] == "file":
+                file_target_append(h, fonte, ts, to_insert)
+
+            elif h["type"] == "sqlite":
+                # INSERT OR IGNORE + índice UNIQUE; sem commit aqui: uma só transação por target
+                extras_col = h.get("extras_column") or ""
+                cols_sql = ", ".join(COLUMNS + ([extras_col] if extras_col else []))
+                ph = ", ".join(["?"] * len(COLUMNS) + (["json(?)"] if extras_col else []))
+                values = []
+                for r in to_insert:
+                    base = tuple(_sqlite_ts(r.get(c)) for c in COLUMNS)
+                    if extras_col:
+                        base += (json.dumps(r.get("extras") or {}, ensure_ascii=False, default=str),)
+                    values.append(base)
+                h["conn"].executemany(f"INSERT OR IGNORE INTO {h['table']} ({cols_sql}) VALUES ({ph})", values)
+
             else:
                 table = h["table"]
                 conn = h["conn"]
@@ -719,6 +1985,167 @@ try:
                     cur.close()
 
             inserted += len(to_insert)
+            for r in to_insert:
+                touched.add((fonte, r.get("lugar"), ts))
+            prof_stop(f"insert @ {target_name}")
+
+        prof_start(f"insert @ {target_name}")
+        if h["type"] == "file":
+            file_target_flush(h)
+        elif h["type"] == "sqlite":
+            h["conn"].commit()
+        prof_stop(f"insert @ {target_name}")
+
+        w_now = time.perf_counter()
+        p_now = time.process_time()
+        watch = w_now - w_prev
+        proc = p_now - p_prev
+        w_prev = w_now
+        p_prev = p_now
+        steps.append({'step': str(f"Write summary @ {target_name}: ins={inserted}, skip={skipped}"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'write', 'target': target_name, 'rows': inserted + skipped, 'inserted': inserted, 'skipped': skipped})
+        prof_annotate(steps[-1], f"dedup @ {target_name}", f"insert @ {target_name}")
+
+        # =========================
+        # 7b) Incremental rollups (só os buckets tocados por esta execução)
+        # =========================
+        if not (h.get("rollups") and touched):
+            continue
+
+        prof_start(f"rollups @ {target_name}")
+        n_buckets = 0
+        try:
+            for grain, delta in ROLLUP_GRAINS:
+                buckets = set()
+                for (fonte, lugar, ts) in touched:
+                    if grain == "hourly":
+                        start = ts.replace(minute=0, second=0, microsecond=0)
+                    else:
+                        start = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+                    buckets.add((fonte, lugar, start))
+
+                # uma query agrupada por grain sobre os (fonte, lugar) tocados e o intervalo [min, max) dos buckets
+                fontes = sorted({b[0] for b in buckets})
+                lugares = sorted({b[1] for b in buckets})
+                t_min = min(b[2] for b in buckets)
+                t_max = max(b[2] for b in buckets) + delta
+
+                if h["type"] == "mongodb":
+                    rcol = h["col"].database[f"{h['col'].name}_{grain}"]
+                    parts = {"year": {"$year": "$data"}, "month": {"$month": "$data"}, "day": {"$dayOfMonth": "$data"}}
+                    if grain == "hourly":
+                        parts["hour"] = {"$hour": "$data"}
+                    group = {"_id": {"fonte": "$fonte", "lugar": "$lugar", "bucket": {"$dateFromParts": parts}}}
+                    for fname, _, magg in ROLLUP_FIELDS:
+                        group[fname] = magg
+
+                    q = {"fonte": {"$in": fontes}, "lugar": {"$in": lugares}, "data": {"$gte": t_min, "$lt": t_max}}
+                    now = datetime.now(timezone.utc).replace(tzinfo=None)
+                    ops = []
+                    for agg in h["col"].aggregate([{"$match": q}, {"$group": group}]):
+                        key = agg.pop("_id")
+                        fonte, lugar, start = key["fonte"], key["lugar"], _rollup_bucket(key["bucket"])
+                        if (fonte, lugar, start) not in buckets:
+                            continue
+                        agg.update({"fonte": fonte, "lugar": lugar, "bucket": start, "updated": now})
+                        ops.append(ReplaceOne({"fonte": fonte, "lugar": lugar, "bucket": start}, agg, upsert=True))
+                    if ops:
+                        rcol.bulk_write(ops, ordered=False)
+                    n_buckets += len(ops)
+
+                else:
+                    table = h["table"]
+                    rtable = f"{table}_{grain}"
+                    conn = h["conn"]
+
+                    is_sqlite = h["type"] == "sqlite"
+                    mark = "?" if is_sqlite else "%s"
+                    conv = _sqlite_ts if is_sqlite else (lambda v: v)
+
+                    if is_sqlite:
+                        bucket_sql = "strftime('%Y-%m-%d %H:00:00', data)" if grain == "hourly" else "strftime('%Y-%m-%d 00:00:00', data)"
+                    elif h["type"] == "mysql":
+                        # sem '%' no SQL (paramstyle pyformat)
+                        bucket_sql = "TIMESTAMP(DATE(data), MAKETIME(HOUR(data), 0, 0))" if grain == "hourly" else "TIMESTAMP(DATE(data))"
+                    else:
+                        bucket_sql = "date_trunc('hour', data)" if grain == "hourly" else "date_trunc('day', data)"
+
+                    fnames = [f for f, _, _ in ROLLUP_FIELDS]
+                    select_sql = (
+                        f"SELECT fonte, lugar, {bucket_sql}, {', '.join(a for _, a, _ in ROLLUP_FIELDS)} FROM {table} "
+                        f"WHERE fonte IN ({', '.join([mark] * len(fontes))}) AND lugar IN ({', '.join([mark] * len(lugares))}) "
+                        f"AND data>={mark} AND data<{mark} GROUP BY fonte, lugar, {bucket_sql}"
+                    )
+                    insert_sql = (
+                        f"INSERT INTO {rtable} (fonte, lugar, bucket, {', '.join(fnames)}, updated) "
+                        f"VALUES ({', '.join([mark] * (3 + len(fnames)))}, CURRENT_TIMESTAMP)"
+                    )
+                    if h["type"] == "mysql":
+                        upsert_sql = insert_sql + " ON DUPLICATE KEY UPDATE " + ", ".join(
+                            [f"{f}=VALUES({f})" for f in fnames] + ["updated=CURRENT_TIMESTAMP"])
+                    elif h["type"] == "cratedb":
+                        upsert_sql = None  # sem UNIQUE fora da PK -> DELETE + INSERT em lote
+                    else:
+                        upsert_sql = insert_sql + " ON CONFLICT (fonte, lugar, bucket) DO UPDATE SET " + ", ".join(
+                            [f"{f}=excluded.{f}" for f in fnames] + ["updated=CURRENT_TIMESTAMP"])
+
+                    cur = conn.cursor()
+                    try:
+                        cur.execute(select_sql, tuple(fontes) + tuple(lugares) + (conv(t_min), conv(t_max)))
+                        values = []
+                        for agg in cur.fetchall():
+                            fonte, lugar, start = agg[0], agg[1], _rollup_bucket(agg[2])
+                            if (fonte, lugar, start) not in buckets:
+                                continue
+                            values.append((fonte, lugar, conv(start)) + tuple(agg[3:]))
+
+                        if values:
+                            if upsert_sql:
+                                cur.executemany(upsert_sql, values)
+                            else:
+                                cur.executemany(f"DELETE FROM {rtable} WHERE fonte={mark} AND lugar={mark} AND bucket={mark}",
+                                                [v[:3] for v in values])
+                                cur.executemany(insert_sql, values)
+                        conn.commit()
+                        n_buckets += len(values)
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        cur.close()
+
+            w_now = time.perf_counter()
+            p_now = time.process_time()
+            watch = w_now - w_prev
+            proc = p_now - p_prev
+            w_prev = w_now
+            p_prev = p_now
+            steps.append({'step': str(f"Rollups @ {target_name}: {n_buckets} buckets"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'rollups', 'target': target_name})
+
+        except Exception as e:
+            errors[f"{target_name}/rollups"] = str(e)
+            w_now = time.perf_counter()
+            p_now = time.process_time()
+            watch = w_now - w_prev
+            proc = p_now - p_prev
+            w_prev = w_now
+            p_prev = p_now
+            steps.append({'step': str(f"Rollups @ {target_name} failed: {e}"), 'status': str("FAIL"), 'watch': float(watch), 'proc': float(proc), 'stage': 'rollups', 'target': target_name})
+        prof_stop(f"rollups @ {target_name}", steps[-1])
+
+    # =========================
+    # 8) Latest-observation snapshot
+    # =========================
+    # só quando algum target guardou as linhas (um insert falhado já saiu por exceção)
+    if LATEST_DB and handles:
+        prof_start("latest snapshot")
+        try:
+            n_latest = latest_update(rows)
+            status = ''
+            label = f"Latest snapshot ({n_latest} estações atualizadas)"
+        except Exception as e:
+            errors["latest"] = str(e)
+            status = "FAIL"
+            label = f"Latest snapshot failed: {e}"
 
         w_now = time.perf_counter()
         p_now = time.process_time()
@@ -726,7 +2153,10 @@ try:
         proc = p_now - p_prev
         w_prev = w_now
         p_prev = p_now
-        steps.append({'step': str(f"Write summary @ {target_name}: ins={inserted}, skip={skipped}"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+        steps.append({'step': str(label), 'status': str(status), 'watch': float(watch), 'proc': float(proc), 'stage': 'latest'})
+        prof_stop("latest snapshot", steps[-1])
+
+    pipeline_ok = True
 
 finally:
     # =========================
@@ -735,7 +2165,7 @@ finally:
     try:
         for h in handles.values():
             try:
-                if h["type"] in ("postgres", "cratedb", "mysql"):
+                if h["type"] in ("postgres", "cratedb", "mysql", "sqlite"):
                     h["conn"].close()
                 elif h["type"] == "mongodb":
                     h["client"].close()
@@ -748,18 +2178,50 @@ finally:
         proc = p_now - p_prev
         w_prev = w_now
         p_prev = p_now
-        steps.append({'step': str("Fecho targets"), 'status': str(''), 'watch': float(watch), 'proc': float(proc)})
+        steps.append({'step': str("Fecho targets"), 'status': str(''), 'watch': float(watch), 'proc': float(proc), 'stage': 'close'})
     except Exception:
         pass
 
+    # =========================
+    # Run history + regressões
+    # =========================
+    regressions = []
+    if HISTORY_DB:
+        try:
+            hist_errors = dict(errors)
+            exc = sys.exc_info()[1]
+            if exc is not None:
+                hist_errors["pipeline"] = str(exc)
+            regressions = history_update(steps, pipeline_ok and not errors, hist_errors,
+                                         ctx["pipeline_name"], ctx["env"], ctx["api_provider"])
+        except Exception as e:
+            print(f"Falha ao gravar histórico de execuções: {e}")
+
+    for rg in regressions:
+        # marca as linhas da tabela PCP da etapa afetada
+        for r in steps:
+            if r.get("stage") == rg["stage"] and str(r.get("target") or "") == rg["target"] and not r["status"]:
+                r["status"] = "SLOW"
+        where = f"{rg['stage']} @ {rg['target']}" if rg["target"] else rg["stage"]
+        extra_lines.append(
+            f"Regressão ({rg['reason']}): {where} = {rg['watch']:.2f}s "
+            f"(mediana {rg['median']:.2f}s, p95 {rg['p95']:.2f}s)"
+        )
+
     # =========================
     # Build HTML summary
     # =========================
+    prof_start("report")
     subject = f"Pipeline {ctx['pipeline_name']} - Relatório de Execução ({ctx['env']})"
     header0 = os.getenv("PIPELINE_PCP_HEADER") or f"Task(s) of {ctx['pipeline_name']} ({ctx['env']})."
 
+    headers = [header0, "watch time (secs)", "proc time (secs)"]
+    if PROFILE:
+        headers += ["peak RSS (MB)", "peak traced (MB)"]
+
     w_total = 0.0
     p_total = 0.0
+    traced_max = 0.0
     rows_tbl = []
     for r in steps:
         w_total += r["watch"]
@@ -767,19 +2229,29 @@ finally:
         label = r["step"]
         if r["status"]:
             label = f"{label} ({r['status']})"
-        rows_tbl.append([label, round(w_total, 2), round(p_total, 2)])
-    rows_tbl.append(["Overall (before email):", round(w_total, 2), round(p_total, 2)])
+        row = [label, round(w_total, 2), round(p_total, 2)]
+        if PROFILE:
+            rss = r.get("rss_mb")
+            traced = r.get("traced_mb")
+            traced_max = max(traced_max, traced or 0.0)
+            row += ["" if rss is None else round(rss, 1), "" if traced is None else round(traced, 2)]
+        rows_tbl.append(row)
+    overall = ["Overall (before email):", round(w_total, 2), round(p_total, 2)]
+    if PROFILE:
+        rss = _peak_rss_mb()
+        overall += ["" if rss is None else round(rss, 1), round(traced_max, 2)]
+    rows_tbl.append(overall)
 
     if HAS_TABULATE:
-        table_html = tabulate(rows_tbl, headers=[header0, "watch time (secs)", "proc time (secs)"], tablefmt="html")
-        table_txt = tabulate(rows_tbl, headers=[header0, "watch time (secs)", "proc time (secs)"])
+        table_html = tabulate(rows_tbl, headers=headers, tablefmt="html")
+        table_txt = tabulate(rows_tbl, headers=headers)
     else:
         table_html = "<table border='1' cellpadding='4' cellspacing='0'>"
-        table_html += f"<tr><th>{header0}</th><th>watch time (secs)</th><th>proc time (secs)</th></tr>"
+        table_html += "<tr>" + "".join(f"<th>{hd}</th>" for hd in headers) + "</tr>"
         for rr in rows_tbl:
-            table_html += f"<tr><td>{rr[0]}</td><td>{rr[1]}</td><td>{rr[2]}</td></tr>"
+            table_html += "<tr>" + "".join(f"<td>{c}</td>" for c in rr) + "</tr>"
         table_html += "</table>"
-        table_txt = "\n".join([f"{rr[0]} | {rr[1]} | {rr[2]}" for rr in rows_tbl])
+        table_txt = "\n".join([" | ".join(str(c) for c in rr) for rr in rows_tbl])
 
     extra_info = (
         f"<p>Pipeline: <b>{ctx['pipeline_name']}</b> | Ambiente: <b>{ctx['env']}</b> | "
@@ -804,56 +2276,39 @@ finally:
     </html>
     """
 
+    prof_stop("report")
+
     # =========================
-    # Send email (Resend -> SMTP fallback)
+    # Send email (outbox -> worker em background)
     # =========================
-    resend_key = (os.getenv("RESEND_API_KEY") or "").strip()
-    resend_from = (os.getenv("RESEND_FROM") or "").strip() or ctx["email_from"]
-
-    sent_ok = False
+    prof_start("email")
+    run_failed = (not pipeline_ok) or bool(errors)
 
-    if resend_key:
+    if EMAIL_POLICY == "never" or (EMAIL_POLICY == "failure" and not (run_failed or regressions)):
+        print(f"Email não enviado (PIPELINE_EMAIL_POLICY={EMAIL_POLICY}).")
+    else:
         try:
-            payload = {"from": resend_from, "to": ctx["email_to"], "subject": subject, "html": body_html}
-            r = requests.post(
-                "https://api.resend.com/emails",
-                headers={"Authorization": f"Bearer {resend_key}", "Content-Type": "application/json"},
-                json=payload,
-                timeout=20,
-            )
-            r.raise_for_status()
-            print("Email enviado com sucesso (Resend).")
-            sent_ok = True
+            outbox_enqueue(subject, body_html, ctx["email_to"], failed=run_failed, regression=bool(regressions))
+            if EMAIL_ASYNC and outbox_spawn_worker():
+                print(f"Email colocado no outbox ({EMAIL_OUTBOX_DIR}); envio em background.")
+            else:
+                outbox_flush()
         except Exception as e:
-            print(f"Falha ao enviar email via Resend: {e}")
+            print(f"Falha ao preparar email: {e}")
+    prof_stop("email")
 
-    if not sent_ok:
+    print("\n--- SUMÁRIO PCP (texto) ---\n")
+    print(table_txt)
+
+    if PROFILE:
         try:
-            msg = MIMEMultipart("alternative")
-            msg["Subject"] = subject
-            msg["To"] = ", ".join(ctx["email_to"])
-
-            smtp_host = os.getenv("SMTP_HOST", "smtp.gmail.com")
-            smtp_port = int(os.getenv("SMTP_PORT", "587"))
-            smtp_user = os.getenv("SMTP_USER")
-            smtp_pass = os.getenv("SMTP_PASS")
-            if not smtp_user or not smtp_pass:
-                raise RuntimeError("Faltam SMTP_USER / SMTP_PASS.")
-
-            email_from = os.getenv("PIPELINE_EMAIL_FROM") or smtp_user or ctx["email_from"]
-            msg["From"] = email_from
-            msg.attach(MIMEText(body_html, "html"))
-
-            with smtplib.SMTP(smtp_host, smtp_port) as server:
-                server.ehlo()
-                server.starttls()
-                server.ehlo()
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
-
-            print("Email enviado com sucesso (SMTP).")
+            prof_dir = prof_dump()
+            if prof_dir:
+                print(f"\nProfiling por etapa em: {prof_dir} (.prof -> python -m pstats / snakeviz)")
         except Exception as e:
-            print(f"Falha ao enviar email (SMTP): {e}")
+            print(f"Falha ao gravar profiling: {e}")
 
-    print("\n--- SUMÁRIO PCP (texto) ---\n")
-    print(table_txt)
+    # exit status != 0 quando há regressões (só se a execução não falhou - nesse caso a exceção segue)
+    if regressions and REGRESSION_EXIT_CODE and sys.exc_info()[1] is None:
+        print(f"\n{len(regressions)} regressão(ões) de performance face à baseline (exit {REGRESSION_EXIT_CODE}).")
+        sys.exit(REGRESSION_EXIT_CODE)